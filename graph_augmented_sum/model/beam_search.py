@@ -1,68 +1,151 @@
 """ beam-search utilities"""
-from collections import Counter
-
-from cytoolz import concat
+import heapq
+from itertools import islice
 import math
+from operator import itemgetter
 
+import numpy as np
 import torch
 
+# accumulate attention coverage on the hyps, for callers that read `.coverage`
+# of the returned hyps (e.g. to re-rank them with coverage_summary); the
+# search itself never reads it
+USE_COVERAGE = False
+
 
 class _Hypothesis(object):
-    def __init__(self, sequence, logprob, hists, attns=[], coverage=None):
+    def __init__(self, token, logprob, hists, parent=None, attn=None,
+                 coverage=None, hist_idx=None):
         """
-        seqence: list of int tokens
+        token: int token of this step (None for a finished hyp whose EOS
+               has been removed)
         logprob: current log probability
         hists: history of prevous convolution list(n_layers)/
                prev_states and output of lstm ((H, C), out)
+        parent: hyp this one was extended from (None at the start)
+        attn: attention of this step (for unk replacement)
+        hist_idx: if given, `hists` holds the histories of the whole beam
+                  at one decoding step and this hyp is row `hist_idx`
+                  (or (row, batch index) if they hold the whole batch)
         """
-        self.sequence = sequence
+        self.token = token
+        self.parent = parent
+        self.length = parent.length if parent is not None else 0
+        if token is not None:
+            self.length += 1
+        self._sequence = None
         self.logprob = logprob
         self.hists = hists
-        self.attns = attns  # for unk replacement
+        self.hist_idx = hist_idx
+        self.attn = attn
         self.coverage = coverage
+        # trigram blocking state, filled in by the parent's extend_k
+        self.repeat_tri = False
+        self._parent_tri_grams = None
 
-    def extend_k(self, topk, logprobs, hists, attn=None, diverse=1.0):
-        if attn is None:
-            attns = []
+    def extend_k(self, topk, logprobs, hists, attn=None, diverse=1.0,
+                 hist_idx=None):
+        if attn is None or not USE_COVERAGE:
             coverage = self.coverage
         else:
-            attns = self.attns + [attn]
+            # coverage stays on the device of `attn`; it is never modified
+            # in place, so all k children share the same tensor
             if self.coverage is None:
-                coverage = attn.detach().cpu()
+                coverage = attn.detach()
             else:
-                coverage = self.coverage + attn.detach().cpu()
-        return [_Hypothesis(self.sequence+[t.item()],
-                            self.logprob+lp.item()-diverse*i, hists, attns, coverage)
+                coverage = self.coverage + attn.detach()
+        # the children carry the histories of the next step; drop ours so
+        # that the parent chain does not keep every step's states alive
+        self.hists = None
+        hyps = [_Hypothesis(t, self.logprob+lp-diverse*i, hists, self,
+                            attn, coverage, hist_idx)
                 for i, (t, lp) in enumerate(zip(topk, logprobs))]
+        # a child repeats a trigram iff we do or its new trigram is one of
+        # ours: a set lookup per candidate instead of a rescan of its
+        # sequence, but building our set copies our parent's (O(length))
+        tri_grams = self._tri_grams()
+        for h in hyps:
+            h.repeat_tri = (self.repeat_tri
+                            or self._next_tri_gram(h.token) in tri_grams)
+            h._parent_tri_grams = tri_grams
+        return hyps
+
+    def _next_tri_gram(self, token):
+        if self.parent is None:
+            return None
+        return (self.parent.token, self.token, token)
+
+    def _tri_grams(self):
+        """ set of the trigrams of the sequence, copied from the parent's
+            once per expanded hyp (the children share it, read-only)"""
+        tri_grams = set(self._parent_tri_grams or ())
+        if self.parent is not None:
+            tri_gram = self.parent._next_tri_gram(self.token)
+            if tri_gram is not None:
+                tri_grams.add(tri_gram)
+        self._parent_tri_grams = None  # only needed to build our own
+        return tri_grams
+
+    @property
+    def sequence(self):
+        """ list of int tokens, materialized by walking the parents"""
+        if self._sequence is None:
+            tokens = []
+            node = self
+            while node is not None and node._sequence is None:
+                if node.token is not None:
+                    tokens.append(node.token)
+                node = node.parent
+            prefix = node._sequence if node is not None else []
+            self._sequence = prefix + tokens[::-1]
+        return self._sequence
+
+    @property
+    def attns(self):
+        attns = []
+        node = self
+        while node is not None:
+            if node.attn is not None:
+                attns.append(node.attn)
+            node = node.parent
+        return attns[::-1]
+
+    @property
+    def logprob(self):
+        return self._logprob
+
+    @logprob.setter
+    def logprob(self, logprob):
+        # cache the length-normalized score used for ranking
+        self._logprob = logprob
+        self.norm_score = logprob / self.length
 
     def __lt__(self, other):
-        return (other.logprob/len(other.sequence)
-                < self.logprob/len(self.sequence))
+        return other.norm_score < self.norm_score
 
 
 def init_beam(start, hists):
     """ get a initial beam to start beam search"""
 
-    return [_Hypothesis([start], 0, hists)]
+    return [_Hypothesis(start, 0, hists)]
 
 
 def create_beam(tok, lp, hists):
     """ initailiza a beam with top k token"""
-    k = tok.size(0)
-    return [_Hypothesis([tok[i].item()], lp[i].item(), hists)
-            for i in range(k)]
+    return [_Hypothesis(t, l, hists)
+            for t, l in zip(tok.tolist(), lp.tolist())]
 
 
 def pack_beam(hyps, device, use_t5=False):
     """pack a list of hypothesis to decoder input batches"""
-    token = torch.LongTensor([h.sequence[-1] for h in hyps])
+    token = torch.LongTensor([h.token for h in hyps])
 
     if use_t5:
         token = token.to(device)
-        states = torch.stack([hyp.hists for hyp in hyps], dim=1)
+        states = _pack_hists(hyps, lambda hists: hists, dim=1)
 
     else:
-        hists = tuple(torch.stack([hyp.hists[i] for hyp in hyps], dim=d)
+        hists = tuple(_pack_hists(hyps, itemgetter(i), dim=d)
                       for i, d in enumerate([1, 1, 0]))
         token = token.to(device)
         states = ((hists[0], hists[1]), hists[2])
@@ -70,39 +153,129 @@ def pack_beam(hyps, device, use_t5=False):
     return token, states
 
 
+def pack_beams(beams, device):
+    """pack the beams of a batch to decoder inputs of shape [beam, batch]"""
+    batch = len(beams)
+    hyps = [h for hyps in zip(*beams) for h in hyps]
+    token, ((h, c), prev) = pack_beam(hyps, device)
+    token = token.view(-1, batch)
+    states = ((h.view(h.size(0), -1, batch, h.size(-1)),
+               c.view(c.size(0), -1, batch, c.size(-1))),
+              prev.view(-1, batch, prev.size(-1)))
+    return token, states
+
+
+def _pack_hists(hyps, get, dim):
+    """gather one history tensor of the hyps along the beam dimension,
+    with a single index_select per decoding step they come from"""
+    parts, positions, steps = [], [], {}
+    for pos, h in enumerate(hyps):
+        if h.hist_idx is None:
+            parts.append(get(h.hists).unsqueeze(dim))
+            positions.append([pos])
+        else:
+            _, step_pos, idx = steps.setdefault(
+                id(h.hists), (get(h.hists), [], []))
+            step_pos.append(pos)
+            idx.append(h.hist_idx)
+    for src, step_pos, idx in steps.values():
+        if isinstance(idx[0], tuple):
+            # histories of the whole batch: index the flattened beam*batch
+            batch = src.size(dim+1)
+            src = src.flatten(dim, dim+1)
+            idx = [row*batch + b for row, b in idx]
+        idx = torch.LongTensor(idx).to(src.device)
+        parts.append(src.index_select(dim, idx))
+        positions.append(step_pos)
+    if len(parts) == 1:
+        return parts[0]
+    packed = torch.cat(parts, dim=dim)
+    order = [pos for step_pos in positions for pos in step_pos]
+    if order != list(range(len(hyps))):
+        inv = [0] * len(order)
+        for i, pos in enumerate(order):
+            inv[pos] = i
+        packed = packed.index_select(
+            dim, torch.LongTensor(inv).to(packed.device))
+    return packed
+
+
+def to_host(*tensors):
+    """copy decoder outputs of the whole batch to the host, queueing all the
+    copies before a single wait instead of syncing once per beam"""
+    if not tensors[0].is_cuda:
+        return tensors
+    host = tuple(t.to('cpu', non_blocking=True) for t in tensors)
+    torch.cuda.current_stream(tensors[0].device).synchronize()
+    return host
+
+
 def next_search_beam(beam, beam_size, finished,
-                     end, topk, lp, hists, attn=None, diverse=1.0):
-    """generate the next beam(K-best hyps)"""
-    topks, lps, hists_list, attns = _unpack_topk(topk, lp, hists, attn)
-    hyps_lists = [h.extend_k(topks[i], lps[i],
-                             hists_list[i], attns[i], diverse)
-                  for i, h in enumerate(beam)]
-    hyps = list(concat(hyps_lists))
-    finished, beam = _clean_beam(finished, hyps, end, beam_size)
+                     end, topk, lp, hists, attn=None, diverse=1.0,
+                     pool=None, max_len=None, batch_idx=None, min_len=None):
+    """generate the next beam(K-best hyps)
+
+    pool: optional list of candidates deferred at previous steps, they
+          compete with the new ones for the beam (updated in place)
+    min_len: if given, drop EOS candidates of hyps shorter than `min_len`
+             tokens; needed with `pool`, since a deferred hyp is expanded
+             after the step at which the decoder stops masking EOS
+    max_len: if given, prune hyps that cannot beat the best finished one;
+             their slots are padded rather than given to worse hyps (the
+             pads are still decoded), so the only saving is the empty beam
+             returned once nothing is left to expand; the best hyp is kept
+             but fewer than `beam_size` may be finished
+    batch_idx: if given, `hists` are the states of the whole batch and
+               this beam is at index `batch_idx` (see `pack_beams`)
+    """
+    hyps = _expand_beam(beam, topk, lp, hists, attn, diverse, batch_idx)
+    finished, beam = _clean_beam(finished, hyps, end, beam_size,
+                                 pool=pool, max_len=max_len, min_len=min_len)
 
     return finished, beam
 
 
 def next_search_beam_cnn(beam, beam_size, finished,
-                     end, topk, lp, hists, attn=None, diverse=1.0):
-    """generate the next beam(K-best hyps)"""
-    topks, lps, hists_list, attns = _unpack_topk(topk, lp, hists, attn)
-    hyps_lists = [h.extend_k(topks[i], lps[i],
-                             hists_list[i], attns[i], diverse)
-                  for i, h in enumerate(beam)]
-    hyps = list(concat(hyps_lists))
-    finished, beam = _clean_beam_cnn(finished, hyps, end, beam_size)
+                     end, topk, lp, hists, attn=None, diverse=1.0,
+                     pool=None, max_len=None, batch_idx=None, min_len=None):
+    """generate the next beam(K-best hyps), ranked by the per-token logprob
+    and dropping repeated trigrams (see `next_search_beam`)"""
+    hyps = _expand_beam(beam, topk, lp, hists, attn, diverse, batch_idx)
+    finished, beam = _clean_beam(finished, hyps, end, beam_size,
+                                 pool=pool, max_len=max_len, min_len=min_len,
+                                 length_penalty=_len_penalty, drop_tri=True)
 
     return finished, beam
 
 
+def _expand_beam(beam, topk, lp, hists, attn, diverse, batch_idx):
+    """extend every hyp of the beam with its top k tokens"""
+    topks, lps, attns = _unpack_topk(topk, lp, attn)
+    return [hyp for i, h in enumerate(beam)
+            for hyp in h.extend_k(topks[i], lps[i], hists, attns[i], diverse,
+                                  hist_idx=i if batch_idx is None
+                                  else (i, batch_idx))]
+
+
+def sorted_finished(finished):
+    """ finished hyps, from the highest prob(normalized by length)"""
+    return [h for *_, h in heapq.nlargest(len(finished), finished)]
+
+
+def active_hyps(beam):
+    """ hyps of the beam that are not padding"""
+    return [h for h in beam if h.logprob != -math.inf]
+
+
 def best_sequence(finished, beam=None):
     """ return the sequence with the highest prob(normalized by length)"""
+    if finished:
+        best_finished = heapq.nlargest(1, finished)[0][-1]
     if beam is None:  # not empty
-        best_beam = finished[0]
+        best_beam = best_finished
     else:
-        if finished and beam[0] < finished[0]:
-            best_beam = finished[0]
+        if finished and beam[0] < best_finished:
+            best_beam = best_finished
         else:
             best_beam = beam[0]
 
@@ -113,23 +286,18 @@ def best_sequence(finished, beam=None):
         return best_seq
 
 
-def _unpack_topk(topk, lp, hists, attn=None):
+def _unpack_topk(topk, lp, attn=None):
     """unpack the decoder output"""
     beam, _ = topk.size()
-    topks = [t for t in topk]
-    lps = [l for l in lp]
-
-    if len(hists) == 3:
-        k_hists = [(hists[0][:, i, :], hists[1][:, i, :], hists[2][i, :])
-                   for i in range(beam)]
-    else:
-        k_hists = [hists[:, i, :] for i in range(beam)]
+    # a single host copy instead of one `.item()` sync per candidate
+    topks = topk.tolist()
+    lps = lp.tolist()
 
     if attn is None:
-        return topks, lps, k_hists
+        attns = [None] * beam
     else:
         attns = [attn[i] for i in range(beam)]
-        return topks, lps, k_hists, attns
+    return topks, lps, attns
 
 def length_wu(cur_len, alpha=0.):
     """GNMT length re-ranking score.
@@ -140,69 +308,117 @@ def length_wu(cur_len, alpha=0.):
 
 def coverage_summary(cov, beta=0.):
     """Our summary penalty."""
-    penalty = torch.max(cov, cov.clone().fill_(1.0)).sum(-1)
-    penalty -= cov.size(-1)
+    penalty = torch.clamp_min(cov, 1.0).sum(-1) - cov.size(-1)
     return beta * penalty
 
-def _clean_beam(finished, beam, end_tok, beam_size, remove_tri=True):
-    """ remove completed sequence from beam """
-    new_beam = []
-    # for h in sorted(beam, reverse=True,
-    #                 key=lambda h: h.logprob/len(h.sequence)):
-    # for h in sorted(beam, reverse=True,
-    #                 key=lambda h: h.logprob / length_wu(len(h.sequence), alpha=0.9) - coverage_summary(h.coverage, beta=5)):
-    for h in sorted(beam, reverse=True,
-                    key=lambda h: h.logprob / length_wu(len(h.sequence), alpha=0.9)):
-        if remove_tri and _has_repeat_tri(h.sequence):
-            h.logprob = -1e9
-        if h.sequence[-1] == end_tok:
-            finished_hyp = _Hypothesis(h.sequence[:-1], # remove EOS
-                                       h.logprob, h.hists, h.attns, h.coverage)
-            finished.append(finished_hyp)
-        else:
-            new_beam.append(h)
-        if len(new_beam) == beam_size:
-            break
-    else:
-        # ensure beam size
-        while len(new_beam) < beam_size:
-            new_beam.append(new_beam[0])
+def _score_arrays(hyps):
+    """ parallel arrays of the hyps' logprobs and lengths, so that ranking
+        keys are computed vectorized instead of per-hyp comparisons"""
+    logprobs = np.fromiter((h.logprob for h in hyps), float, len(hyps))
+    lengths = np.fromiter((h.length for h in hyps), int, len(hyps))
+    return logprobs, lengths
 
-    finished = sorted(finished, reverse=True,
-                      key=lambda h: h.logprob/len(h.sequence))
-    return finished, new_beam
 
-def _clean_beam_cnn(finished, beam, end_tok, beam_size, remove_tri=True):
-    """ remove completed sequence from beam """
+def _iter_ranked(hyps, scores):
+    """ yield hyps from the best to the worst score (stable for ties)"""
+    return (hyps[i] for i in np.argsort(-scores, kind='stable'))
+
+
+def _wu_penalty(length):
+    return length_wu(length, alpha=0.9)
+
+
+def _len_penalty(length):
+    return length
+
+
+def _clean_beam(finished, beam, end_tok, beam_size, remove_tri=True,
+                pool=None, max_len=None, length_penalty=_wu_penalty,
+                drop_tri=False, min_len=None):
+    """ remove completed sequence from beam
+
+    length_penalty: hyps are ranked by logprob / length_penalty(length)
+    drop_tri: drop hyps with a repeated trigram instead of keeping them
+              with a -1e9 logprob
+    """
     new_beam = []
-    # for h in sorted(beam, reverse=True,
-    #                 key=lambda h: h.logprob/len(h.sequence)):
-    # for h in sorted(beam, reverse=True,
-    #                 key=lambda h: h.logprob / length_wu(len(h.sequence), alpha=0.9) - coverage_summary(h.coverage, beta=5)):
-    for h in sorted(beam, reverse=True,
-                    key=lambda h: h.logprob / len(h.sequence)):
-        if remove_tri and _has_repeat_tri(h.sequence):
+    pruned = 0
+    if pool:
+        beam = beam + pool
+    floor = _prune_floor(finished, max_len)
+    logprobs, lengths = _score_arrays(beam)
+    scores = logprobs / length_penalty(lengths)
+    # scores -= coverage_summary(coverage, beta=5)
+    ranked = _iter_ranked(beam, scores)
+    for rank, h in enumerate(ranked):
+        if h.logprob == -math.inf:
+            break  # only padding is left
+        if remove_tri and h.repeat_tri:
             h.logprob = -1e9
+            if drop_tri:
+                continue
+        if (h.token == end_tok and min_len is not None
+                and h.length < min_len + 2):  # start, min_len tokens, EOS
             continue
-        if h.sequence[-1] == end_tok:
-            finished_hyp = _Hypothesis(h.sequence[:-1], # remove EOS
-                                       h.logprob, h.hists, h.attns)
-            finished.append(finished_hyp)
+        if h.token == end_tok:
+            finished_hyp = _Hypothesis(None, # remove EOS
+                                       h.logprob, h.hists, h.parent, h.attn,
+                                       h.coverage)
+            _push_finished(finished, finished_hyp, beam_size, rank)
+            floor = _prune_floor(finished, max_len)
+        elif h.logprob < floor:
+            pruned += 1  # cannot beat the best finished hyp, slot is padded
         else:
             new_beam.append(h)
-        if len(new_beam) == beam_size:
+        if len(new_beam) + pruned == beam_size:
             break
-    else:
-        # ensure beam size
-        while len(new_beam) < beam_size:
-            new_beam.append(new_beam[0])
+    if pool is not None:
+        _refill_pool(pool, ranked, beam_size, floor)
+    if not new_beam and not pool:
+        return finished, []  # nothing left to expand
+    _pad_beam(new_beam, beam, beam_size)
 
-    finished = sorted(finished, reverse=True,
-                      key=lambda h: h.logprob/len(h.sequence))
     return finished, new_beam
 
 
-def _has_repeat_tri(grams):
-    tri_grams = [tuple(grams[i:i+3]) for i in range(len(grams)-2)]
-    cnt = Counter(tri_grams)
-    return not all((cnt[g] <= 1 for g in cnt))
+def _pad_beam(new_beam, candidates, beam_size):
+    """ ensure beam size for batching with inactive hyps (-inf logprob)
+        that can never be selected again, instead of duplicating live ones
+    """
+    ref = new_beam[0] if new_beam else candidates[0]
+    while len(new_beam) < beam_size:
+        new_beam.append(_Hypothesis(ref.token, -math.inf, ref.hists,
+                                    ref.parent, ref.attn, ref.coverage,
+                                    ref.hist_idx))
+
+
+def _refill_pool(pool, ranked, size, floor=-math.inf):
+    """ defer the `size` best candidates left over by the beam so that they
+        can still be expanded at a later step (best-first exploration)"""
+    pool[:] = [h for h in islice(ranked, size)
+               if h.logprob != -math.inf and h.logprob >= floor]
+
+
+def _prune_floor(finished, max_len=None):
+    """ lowest logprob a live hyp needs to possibly beat the best finished
+        one, by the normalized score that orders the outputs or by the GNMT
+        score: logprob only decreases as the hyp is extended and both length
+        penalties grow with the length, so logprob / penalty(max_len+1) is
+        an admissible upper bound of either score
+    """
+    if not max_len or not finished:
+        return -math.inf
+    return min(max(h.logprob / penalty(h.length) for *_, h in finished)
+               * penalty(max_len+1)
+               for penalty in (_len_penalty, _wu_penalty))
+
+
+def _push_finished(finished, hyp, size, rank=0):
+    """ keep the `size` best finished hyps as a min-heap on the normalized
+        score, the worst one is dropped first; ties go to the hyp finished
+        first (shorter, then better ranked within its step)"""
+    item = (hyp.norm_score, -hyp.length, -rank, hyp)
+    if len(finished) < size:
+        heapq.heappush(finished, item)
+    else:
+        heapq.heappushpop(finished, item)
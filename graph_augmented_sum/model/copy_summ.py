@@ -271,7 +271,8 @@ class CopySumm(Seq2SeqSumm):
 
     def batched_beamsearch(self, article, art_lens,
                            extend_art, extend_vsize,
-                           go, eos, unk, max_len, beam_size, diverse=1.0, min_len=35):
+                           go, eos, unk, max_len, beam_size, diverse=1.0, min_len=35,
+                           best_first=False, prune=False):
         batch_size = len(art_lens)
         vsize = self._embedding.num_embeddings
         attention, init_dec_states = self.encode(article, art_lens)
@@ -282,18 +283,17 @@ class CopySumm(Seq2SeqSumm):
         all_beams = [bs.init_beam(go, (h[:, i, :], c[:, i, :], prev[i]))
                      for i in range(batch_size)]
         finished_beams = [[] for _ in range(batch_size)]
+        # best_first: candidates left over by a beam are kept in a pool and
+        # compete with the next step's, instead of a lockstep search; this
+        # changes the outputs (the best hyp can be better or worse)
+        pools = [[] if best_first else None for _ in range(batch_size)]
+        # prune: stop an article once no live hyp can beat its best finished
+        # one; keeps the best hyp but may return fewer than beam_size hyps
+        prune_len = max_len if prune else None
         outputs = [None for _ in range(batch_size)]
         for t in range(max_len):
-            toks = []
-            all_states = []
-            for beam in filter(bool, all_beams):
-                token, states = bs.pack_beam(beam, article.device)
-                toks.append(token)
-                all_states.append(states)
-            token = torch.stack(toks, dim=1)
-            states = ((torch.stack([h for (h, _), _ in all_states], dim=2),
-                       torch.stack([c for (_, c), _ in all_states], dim=2)),
-                      torch.stack([prev for _, prev in all_states], dim=1))
+            token, states = bs.pack_beams(list(filter(bool, all_beams)),
+                                          article.device)
             token.masked_fill_(token >= vsize, unk)
 
             if t < min_len:
@@ -303,6 +303,8 @@ class CopySumm(Seq2SeqSumm):
             topk, lp, states, attn_score = self._decoder.topk_step(
                 token, states, attention, beam_size, force_not_stop=force_not_stop, eos=eos)
 
+            topk, lp = bs.to_host(topk, lp)
+            step_hists = (states[0][0], states[0][1], states[1])
             batch_i = 0
             for i, (beam, finished) in enumerate(zip(all_beams,
                                                      finished_beams)):
@@ -311,16 +313,15 @@ class CopySumm(Seq2SeqSumm):
                 finished, new_beam = bs.next_search_beam(
                     beam, beam_size, finished, eos,
                     topk[:, batch_i, :], lp[:, batch_i, :],
-                    (states[0][0][:, :, batch_i, :],
-                     states[0][1][:, :, batch_i, :],
-                     states[1][:, batch_i, :]),
-                    attn_score[:, batch_i, :],
-                    diverse
+                    step_hists, attn_score[:, batch_i, :],
+                    diverse, pool=pools[i], max_len=prune_len,
+                    batch_idx=batch_i,
+                    min_len=min_len if best_first else None
                 )
                 batch_i += 1
-                if len(finished) >= beam_size:
+                if len(finished) >= beam_size or not new_beam:
                     all_beams[i] = []
-                    outputs[i] = finished[:beam_size]
+                    outputs[i] = bs.sorted_finished(finished)
                     # exclude finished inputs
                     (attention, mask, extend_art, extend_vsize
                     ) = all_attention
@@ -341,18 +342,20 @@ class CopySumm(Seq2SeqSumm):
                 else:
                     all_beams[i] = new_beam
                     finished_beams[i] = finished
-            if all(outputs):
+            if all(o is not None for o in outputs):
                 break
         else:
             for i, (o, f, b) in enumerate(zip(outputs,
                                               finished_beams, all_beams)):
                 if o is None:
-                    outputs[i] = (f+b)[:beam_size]
+                    outputs[i] = (bs.sorted_finished(f)
+                                  + bs.active_hyps(b))[:beam_size]
         return outputs
 
     def batched_beamsearch_cnn(self, article, art_lens,
                            extend_art, extend_vsize,
-                           go, eos, unk, max_len, beam_size, diverse=1.0, min_len=35):
+                           go, eos, unk, max_len, beam_size, diverse=1.0, min_len=35,
+                           best_first=False, prune=False):
         batch_size = len(art_lens)
         vsize = self._embedding.num_embeddings
         attention, init_dec_states = self.encode(article, art_lens)
@@ -363,18 +366,17 @@ class CopySumm(Seq2SeqSumm):
         all_beams = [bs.init_beam(go, (h[:, i, :], c[:, i, :], prev[i]))
                      for i in range(batch_size)]
         finished_beams = [[] for _ in range(batch_size)]
+        # best_first: candidates left over by a beam are kept in a pool and
+        # compete with the next step's, instead of a lockstep search; this
+        # changes the outputs (the best hyp can be better or worse)
+        pools = [[] if best_first else None for _ in range(batch_size)]
+        # prune: stop an article once no live hyp can beat its best finished
+        # one; keeps the best hyp but may return fewer than beam_size hyps
+        prune_len = max_len if prune else None
         outputs = [None for _ in range(batch_size)]
         for t in range(max_len):
-            toks = []
-            all_states = []
-            for beam in filter(bool, all_beams):
-                token, states = bs.pack_beam(beam, article.device)
-                toks.append(token)
-                all_states.append(states)
-            token = torch.stack(toks, dim=1)
-            states = ((torch.stack([h for (h, _), _ in all_states], dim=2),
-                       torch.stack([c for (_, c), _ in all_states], dim=2)),
-                      torch.stack([prev for _, prev in all_states], dim=1))
+            token, states = bs.pack_beams(list(filter(bool, all_beams)),
+                                          article.device)
             token.masked_fill_(token >= vsize, unk)
 
             if t < min_len:
@@ -384,6 +386,8 @@ class CopySumm(Seq2SeqSumm):
             topk, lp, states, attn_score = self._decoder.topk_step(
                 token, states, attention, beam_size, force_not_stop=force_not_stop, eos=eos)
 
+            topk, lp = bs.to_host(topk, lp)
+            step_hists = (states[0][0], states[0][1], states[1])
             batch_i = 0
             for i, (beam, finished) in enumerate(zip(all_beams,
                                                      finished_beams)):
@@ -392,16 +396,15 @@ class CopySumm(Seq2SeqSumm):
                 finished, new_beam = bs.next_search_beam_cnn(
                     beam, beam_size, finished, eos,
                     topk[:, batch_i, :], lp[:, batch_i, :],
-                    (states[0][0][:, :, batch_i, :],
-                     states[0][1][:, :, batch_i, :],
-                     states[1][:, batch_i, :]),
-                    attn_score[:, batch_i, :],
-                    diverse
+                    step_hists, attn_score[:, batch_i, :],
+                    diverse, pool=pools[i], max_len=prune_len,
+                    batch_idx=batch_i,
+                    min_len=min_len if best_first else None
                 )
                 batch_i += 1
-                if len(finished) >= beam_size:
+                if len(finished) >= beam_size or not new_beam:
                     all_beams[i] = []
-                    outputs[i] = finished[:beam_size]
+                    outputs[i] = bs.sorted_finished(finished)
                     # exclude finished inputs
                     (attention, mask, extend_art, extend_vsize
                     ) = all_attention
@@ -422,13 +425,14 @@ class CopySumm(Seq2SeqSumm):
                 else:
                     all_beams[i] = new_beam
                     finished_beams[i] = finished
-            if all(outputs):
+            if all(o is not None for o in outputs):
                 break
         else:
             for i, (o, f, b) in enumerate(zip(outputs,
                                               finished_beams, all_beams)):
                 if o is None:
-                    outputs[i] = (f+b)[:beam_size]
+                    outputs[i] = (bs.sorted_finished(f)
+                                  + bs.active_hyps(b))[:beam_size]
         return outputs
 
 
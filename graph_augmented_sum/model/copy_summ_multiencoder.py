@@ -571,7 +571,8 @@ class CopySummIDGL(Seq2SeqSumm):
     def batched_beamsearch(self, article, art_lens,
                            extend_art, extend_vsize,
                            ninfo, rinfo, ext_ninfo,
-                           go, eos, unk, max_len, beam_size, diverse=1.0, min_len=35):
+                           go, eos, unk, max_len, beam_size, diverse=1.0, min_len=35,
+                           best_first=False, prune=False):
         (nodes, nmask, node_num, sw_mask, feature_dict) = ninfo
         (relations, rmask, triples, adjs) = rinfo
         if self._gold:
@@ -612,31 +613,27 @@ class CopySummIDGL(Seq2SeqSumm):
         else:
             all_nodes = [(nodes[i, :, :], node_num[i]) for i in range(len(node_num))]
         finished_beams = [[] for _ in range(batch_size)]
+        # best_first: candidates left over by a beam are kept in a pool and
+        # compete with the next step's, instead of a lockstep search; this
+        # changes the outputs (the best hyp can be better or worse)
+        pools = [[] if best_first else None for _ in range(batch_size)]
+        # prune: stop an article once no live hyp can beat its best finished
+        # one; keeps the best hyp but may return fewer than beam_size hyps
+        prune_len = max_len if prune else None
         outputs = [None for _ in range(batch_size)]
 
         for t in range(max_len):
 
-            all_states = []
-            toks = []
             # with t = 0 len(beam) = 1, with t > 0 len(beam) = 5
             # at the first step we just have 1 because we consider just the eos token
             # we don't have to store the top 5 most likely hypothesis
-            for beam in filter(bool, all_beams):
-                token, states = bs.pack_beam(beam, article.device, use_t5=False)
-                all_states.append(states)
-
-                toks.append(token)
-
-            token = torch.stack(toks, dim=1)
-            # mask tokens that are not in the vocabulary with the unk token
-            token.masked_fill_(token >= vsize, unk)
-
             # states[0][0] contains the hidden states e.g. (1, 1, 32, 256) at t=0 and (1, 5, 32, 256) at t > 0
             # states[0][1] contains the cell states e.g. (1, 1, 32, 256) at t=0 and (1, 5, 32, 256) at t > 0
             # state[1] contains the prev_states e.g. (1, 32, 768) at t=0 and (5, 32, 768) at t > 0
-            states = ((torch.stack([h for (h, _), _ in all_states], dim=2),
-                       torch.stack([c for (_, c), _ in all_states], dim=2)),
-                      torch.stack([prev for _, prev in all_states], dim=1))
+            token, states = bs.pack_beams(list(filter(bool, all_beams)),
+                                          article.device)
+            # mask tokens that are not in the vocabulary with the unk token
+            token.masked_fill_(token >= vsize, unk)
 
             filtered_nodes = torch.stack([all_nodes[i][0] for i, _beam in enumerate(all_beams) if _beam != []], dim=0)
             filtered_node_num = [all_nodes[i][1] for i, _beam in enumerate(all_beams) if _beam != []]
@@ -659,6 +656,8 @@ class CopySummIDGL(Seq2SeqSumm):
                 max_node_num=max_node_num, side_mask=filtered_sw_mask, force_not_stop=force_not_stop,
                 filtered_ext_info=filtered_ext_info, eos=eos)
 
+            topk, lp = bs.to_host(topk, lp)
+            step_hists = (states[0][0], states[0][1], states[1])
             batch_i = 0
             for i, (beam, finished) in enumerate(zip(all_beams,
                                                      finished_beams)):
@@ -668,17 +667,16 @@ class CopySummIDGL(Seq2SeqSumm):
                 finished, new_beam = bs.next_search_beam(
                     beam, beam_size, finished, eos,
                     topk[:, batch_i, :], lp[:, batch_i, :],
-                    (states[0][0][:, :, batch_i, :],
-                     states[0][1][:, :, batch_i, :],
-                     states[1][:, batch_i, :]),
-                    attn_score[:, batch_i, :],
-                    diverse
+                    step_hists, attn_score[:, batch_i, :],
+                    diverse, pool=pools[i], max_len=prune_len,
+                    batch_idx=batch_i,
+                    min_len=min_len if best_first else None
                 )
 
                 batch_i += 1
-                if len(finished) >= beam_size:
+                if len(finished) >= beam_size or not new_beam:
                     all_beams[i] = []
-                    outputs[i] = finished[:beam_size]
+                    outputs[i] = bs.sorted_finished(finished)
                     # exclude finished inputs
                     (attention, mask, extend_art, extend_vsize
                      ) = all_attention
@@ -699,13 +697,14 @@ class CopySummIDGL(Seq2SeqSumm):
                 else:
                     all_beams[i] = new_beam
                     finished_beams[i] = finished
-            if all(outputs):
+            if all(o is not None for o in outputs):
                 break
         else:
             for i, (o, f, b) in enumerate(zip(outputs,
                                               finished_beams, all_beams)):
                 if o is None:
-                    outputs[i] = (f + b)[:beam_size]
+                    outputs[i] = (bs.sorted_finished(f)
+                                  + bs.active_hyps(b))[:beam_size]
         return outputs
 
 